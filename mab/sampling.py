@@ -27,11 +27,14 @@
 #  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  
 
 import uuid
-from utils import Sample
+from utils import Sample, fft_kde_cdf, make_random_state
 import logging
 import numpy as np
 from scipy.stats import gaussian_kde
 import subprocess
+from multiprocessing.pool import ThreadPool
+import os
+import shlex
 
 class Sampler(object):
     """
@@ -51,12 +54,34 @@ class Sampler(object):
         calculates the boolean validity of the sample.
     constants: dict
         The set of constants that are part of every sample.
+    random_state: numpy.random.Generator or numpy.random.RandomState
+        The random number generator owned by the Sampler, seeded with the optional seed argument.
+    dtype: numpy.dtype
+        The float type of generated attribute values. np.float32 halves the memory traffic of large batches
+        when single precision is accurate enough.
+    vectorize_metric: bool
+        When set, metric_function and valid_function are first tried on a whole batch at once: they are called
+        with a dictionary mapping each attribute name to its column of values. Functions written with arithmetic
+        and comparisons work unchanged. Every batch result is checked against per sample calls on its first
+        rows, and functions that raise, do not return one value per sample, or disagree with the per sample
+        results fall back to per sample evaluation. Off by default; leave off for functions with side effects.
     """
-    def __init__(self, attribute_names, metric_function, valid_function, constants):
+    def __init__(self, attribute_names, metric_function, valid_function, constants, seed = None, dtype = np.float64, vectorize_metric = False):
         self.attribute_names = attribute_names
         self.metric_function = metric_function
         self.valid_function = valid_function
         self.constants = constants
+        self.seed = seed
+        self.random_state = make_random_state(seed)
+        self.dtype = dtype
+        self.vectorize_metric = vectorize_metric
+        self._scalar_functions = set()
+        # The column layout of generated samples is fixed, so it is worked out once here.
+        self._attr_list = list(attribute_names)
+        self._const_set = frozenset(constants)
+        self._const_indices = [i for i, name in enumerate(self._attr_list) if name in self._const_set]
+        self._varying_indices = [i for i, name in enumerate(self._attr_list) if name not in self._const_set]
+        self._varying_names = [self._attr_list[i] for i in self._varying_indices]
 
     def make_sample(self, attribute_values):
         """
@@ -73,9 +98,193 @@ class Sampler(object):
         attributes.update(self.constants)
         return Sample(attributes, self.metric_function, self.valid_function)
 
+    def make_samples(self, attribute_values):
+        """
+        Generates a list of samples, one per row of attribute values. Equivalent to mapping
+        :py:func:`sampling.Sampler.make_sample` over the rows, but the constants are only
+        copied from a prebuilt template instead of being merged into every row.
+        
+        ...
+        
+        Parameters
+        __________
+        attribute_values: 2d array
+            The rows of values to generate samples from. Columns follow the order of attribute_names.
+        """
+        if len(attribute_values) == 0:
+            return []
+        names = self._varying_names
+        if self._const_indices:
+            # Constants take precedence over sampled values, so their columns are dropped.
+            attribute_values = np.asarray(attribute_values)[:, self._varying_indices]
+        metrics = self.evaluate(self.metric_function, attribute_values)
+        valids = self.evaluate(self.valid_function, attribute_values)
+        template = dict(self.constants)
+        samples = []
+        for values, metric, valid in zip(attribute_values, metrics, valids):
+            attributes = template.copy()
+            attributes.update(zip(names, values))
+            samples.append(Sample(attributes, self.metric_function, self.valid_function, metric, valid))
+        return samples
+
+    def evaluate(self, function, attribute_values):
+        """
+        Evaluates a metric or validity function on a whole batch with one call, see vectorize_metric.
+        
+        ...
+        
+        Parameters
+        __________
+        function: function
+            metric_function or valid_function.
+        attribute_values: 2d array
+            The rows of values of the samples that are not constants. Columns follow the order of the
+            non-constant attribute_names.
+
+        Returns
+        _______
+        values:
+            The list of per sample results, or a list of None when the function has to be evaluated per sample.
+        """
+        count = len(attribute_values)
+        if not self.vectorize_metric or function in self._scalar_functions:
+            return [None]*count
+        columns = dict(self.constants)
+        columns.update(zip(self._varying_names, np.transpose(attribute_values)))
+        try:
+            values = np.asarray(function(columns))
+        except Exception:
+            values = None
+        if values is None or values.shape != (count,) or not self.matches_per_sample(function, attribute_values, values):
+            self._scalar_functions.add(function)
+            return [None]*count
+        return values.tolist()
+
+    def matches_per_sample(self, function, attribute_values, values, rows = 2):
+        """
+        Checks a batch result of function against calling it on single samples. Functions such as
+        np.dot can return one value per sample from a batch call and still compute something else.
+        
+        ...
+        
+        Parameters
+        __________
+        function: function
+            metric_function or valid_function.
+        attribute_values: 2d array
+            The rows of values of the samples that are not constants, as passed to evaluate.
+        values: array
+            The result of the batch call.
+        rows: int
+            The number of leading rows to check.
+        """
+        template = dict(self.constants)
+        try:
+            for row, value in zip(attribute_values[:rows], values):
+                attributes = template.copy()
+                attributes.update(zip(self._varying_names, row))
+                if not np.isclose(float(function(attributes)), float(value), equal_nan = True):
+                    return False
+        except Exception:
+            return False
+        return True
+
     def get_samples(self, count):
+        """
+        Generates a list of samples. Implementations of get_samples_array get this for free.
+        
+        ...
+        
+        Parameters
+        __________
+        count: int
+            The number of samples to obtain.
+        """
+        if count == 0:
+            return []
+        return self.make_samples(self.get_samples_array(count))
+
+    def get_samples_array(self, count):
+        """
+        Generates the attribute values of a batch of samples without building :py:class:`utils.Sample` objects.
+        
+        ...
+        
+        Parameters
+        __________
+        count: int
+            The number of samples to obtain.
+
+        Returns
+        _______
+        values:
+            A (count, len(attribute_names)) array with columns in the order of attribute_names.
+        """
         raise NotImplementedError('Get samples not implemented')
 
+    def buffer_paths(self):
+        """
+        The files that a batch of this sampler writes and reads. :py:class:`sampling.SamplerSet` runs batches
+        of samplers that share any of these files one after another. In-process samplers use none.
+        """
+        return frozenset()
+
+    def get_samples_async(self, count):
+        """
+        Starts generating a batch of samples and returns a :py:class:`sampling.SampleFuture` for it.
+        
+        Samplers that depend on external work (e.g. tool runs) should override this to start that
+        work before returning. The default defers to get_samples when the result is requested.
+        
+        ...
+        
+        Parameters
+        __________
+        count: int
+            The number of samples to obtain.
+        """
+        return SampleFuture(lambda: self.get_samples(count))
+
+class SampleFuture(object):
+    """
+    Handle to a batch of samples that may still be in progress.
+    
+    ...
+    
+    Attributes
+    __________
+    collect: function
+        The function that returns the list of samples once the batch is complete. When read is given, it is
+        called with the result of read.
+    process: subprocess.Popen
+        The optional process that generates the batch. It is waited on before collect is called.
+    read: function
+        The optional function that gathers the raw output of process as soon as it finishes.
+    """
+    def __init__(self, collect, process = None, read = None):
+        self.collect = collect
+        self.process = process
+        self.read = read
+        self._waited = False
+        self._output = None
+        self._samples = None
+
+    def wait(self):
+        """Blocks until the process finishes and runs read. Does not call collect, so no user callbacks run."""
+        if not self._waited:
+            if self.process is not None:
+                self.process.wait()
+            if self.read is not None:
+                self._output = self.read()
+            self._waited = True
+
+    def result(self):
+        """Blocks until the batch is complete and returns its samples."""
+        if self._samples is None:
+            self.wait()
+            self._samples = self.collect(self._output) if self.read is not None else self.collect()
+        return self._samples
+
 class SamplerSet:
     """
     Class to wrap a set of samplers and allow sampling the set for given batch sizes.
@@ -86,9 +295,16 @@ class SamplerSet:
     __________
     samplers: list
         The set of samplers to generate the SamplerSet from.
+    random_state: numpy.random.Generator or numpy.random.RandomState
+        The random number generator used for draws shared between samplers, seeded with the optional seed argument.
+        Only unseeded GaussianSamplers share these draws; samplers created with a seed always draw from their own
+        random_state so that their output stays reproducible inside the set.
     """
-    def __init__(self, samplers):
+    def __init__(self, samplers, seed = None):
         self.samplers = samplers
+        self.random_state = make_random_state(seed)
+        # Unseeded GaussianSamplers can share a single standard normal draw per round.
+        self._gaussian_indices = [i for i, s in enumerate(samplers) if type(s) is GaussianSampler and s.seed is None]
 
     def get_samples(self, sample_counts):
         """
@@ -101,7 +317,74 @@ class SamplerSet:
         sample_counts: int
             The number of samples to obtain.
         """
-        return [s.get_samples(c) for s, c in zip(self.samplers, sample_counts)]
+        batched = [i for i in self._gaussian_indices if sample_counts[i] > 0]
+        if len(batched) < 2:
+            batched = []
+        # Tool runs that share a buffer file would overwrite each other's parameters and output, so arms are
+        # grouped by the files they use. Groups run concurrently; the arms within a group run one after another.
+        groups = []
+        for i, (s, c) in enumerate(zip(self.samplers, sample_counts)):
+            paths = s.buffer_paths() if c > 0 and i not in batched else frozenset()
+            if paths:
+                overlapping = [g for g in groups if g[0] & paths]
+                groups = [g for g in groups if not g[0] & paths]
+                groups.append((paths.union(*[g[0] for g in overlapping]), sorted(sum([g[1] for g in overlapping], []) + [i])))
+        grouped = set(i for paths, chain in groups for i in chain)
+        deferred = set(i for paths, chain in groups for i in chain[1:])
+        # Start every other batch before waiting on any of them so that tool runs overlap.
+        pending = [None if i in batched or i in deferred else s.get_samples_async(c) for i, (s, c) in enumerate(zip(self.samplers, sample_counts))]
+        gaussian_samples = self.get_gaussian_samples(batched, sample_counts)
+        chains = [chain for paths, chain in groups]
+        chains += [[i] for i, p in enumerate(pending) if i not in grouped and p is not None and p.process is not None]
+        local = [i for i, p in enumerate(pending) if i not in grouped and p is not None and p.process is None]
+
+        def run_chain(chain):
+            for previous, i in zip(chain, chain[1:]):
+                pending[previous].wait()
+                pending[i] = self.samplers[i].get_samples_async(sample_counts[i])
+            pending[chain[-1]].wait()
+
+        # Waiting on the tool runs of process backed batches happens on worker threads so that the waits overlap.
+        # Building the samples, including the user's metric and validity callbacks, stays on the calling thread.
+        pool = ThreadPool(len(chains)) if len(chains) > 1 else None
+        try:
+            finished = pool.map_async(run_chain, chains) if pool is not None else None
+            for i in local:
+                pending[i].result()
+            if finished is None:
+                map(run_chain, chains)
+            else:
+                finished.get()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return [gaussian_samples[i] if p is None else p.result() for i, p in enumerate(pending)]
+
+    def get_gaussian_samples(self, indices, sample_counts):
+        """
+        Samples a group of GaussianSamplers from a single standard normal draw, split between them by count.
+        
+        ...
+        
+        Parameters
+        __________
+        indices: list
+            The positions of the GaussianSamplers to sample.
+        sample_counts: list
+            The number of samples to obtain per sampler, indexed like samplers.
+
+        Returns
+        _______
+        samples:
+            Dict from sampler position to its list of samples.
+        """
+        if not indices:
+            return {}
+        counts = [int(sample_counts[i]) for i in indices]
+        width = max(self.samplers[i].attribute_count() for i in indices)
+        draws = np.split(self.random_state.standard_normal((sum(counts), width)), np.cumsum(counts)[:-1])
+        return dict((i, self.samplers[i].make_samples(self.samplers[i].scale(d))) for i, d in zip(indices, draws))
 
     def __len__(self):
         return len(self.samplers)
@@ -119,17 +402,65 @@ class GaussianSampler(Sampler):
     attribute_stds: list
         The standard deviation to use per attribute. The order of attributes is the same as in attribute_names.
     """ 
-    def __init__(self, attribute_names, metric_function, valid_function, constants, attribute_means, attribute_stds):
-        super(GaussianSampler, self).__init__(attribute_names, metric_function, valid_function, constants)
+    def __init__(self, attribute_names, metric_function, valid_function, constants, attribute_means, attribute_stds, seed = None, dtype = np.float64, vectorize_metric = False):
+        super(GaussianSampler, self).__init__(attribute_names, metric_function, valid_function, constants, seed, dtype, vectorize_metric)
         self.attribute_means = attribute_means
         self.attribute_stds = attribute_stds
+        self._means = np.asarray(attribute_means, dtype = dtype)
+        self._stds = np.asarray(attribute_stds, dtype = dtype)
         self.logger = logging.getLogger('Gaussian Sampler ' + str(id(self)))
 
-    def get_samples(self, count):
-        if count == 0:
-            return []
-        samples = np.random.multivariate_normal(self.attribute_means, np.diag(self.attribute_stds)**2, int(count))
-        return map(self.make_sample, samples)
+    def get_samples_array(self, count):
+        return self.scale(self.random_state.standard_normal((int(count), self.attribute_count())))
+
+    def attribute_count(self):
+        return self._means.size
+
+    def scale(self, standard_normals):
+        """
+        Maps standard normal draws to samples of this sampler's distribution. The covariance is
+        diagonal, so this is equivalent to multivariate_normal without factorizing the covariance matrix.
+        
+        ...
+        
+        Parameters
+        __________
+        standard_normals: 2d array
+            Standard normal draws with one row per sample. Only the first attribute_count() columns are used.
+        """
+        return self._means + self._stds*standard_normals[:, :self._means.size].astype(self.dtype, copy = False)
+
+class CachedGaussianKde(gaussian_kde):
+    """
+    A scipy.stats.gaussian_kde that keeps the Cholesky factor of its kernel covariance and the cumulative
+    dataset weights, so that resample does not factorize the covariance on every call.
+    
+    ...
+    
+    Parameters
+    __________
+    dataset: array
+        The data to fit, as accepted by scipy.stats.gaussian_kde.
+    random_state: numpy.random.Generator or numpy.random.RandomState
+        The generator to draw from. Defaults to a new unseeded generator.
+    """
+    def __init__(self, dataset, random_state = None, **kwargs):
+        self.random_state = make_random_state() if random_state is None else random_state
+        super(CachedGaussianKde, self).__init__(dataset, **kwargs)
+
+    def _compute_covariance(self):
+        # Called whenever the bandwidth is set, which keeps the cached values in sync with the covariance.
+        super(CachedGaussianKde, self)._compute_covariance()
+        self.cho_cov = np.linalg.cholesky(self.covariance)
+        weights = getattr(self, 'weights', None)
+        self._weight_cdf = np.cumsum(weights) if weights is not None else np.arange(1., self.n + 1)
+
+    def resample(self, size = None):
+        if size is None:
+            size = int(getattr(self, 'neff', self.n))
+        indices = np.searchsorted(self._weight_cdf, self.random_state.uniform(size = size)*self._weight_cdf[-1], side = 'right')
+        noise = np.dot(self.cho_cov, self.random_state.standard_normal((self.d, size)))
+        return self.dataset[:, np.minimum(indices, self.n - 1)] + noise
 
 class KdeSampler(Sampler):
     """
@@ -142,23 +473,59 @@ class KdeSampler(Sampler):
     attribute_data: dict
         Dict containing the mapping from attribute name -> list of data. This data is used in the KDE model
         to generate new samples.
+    grid_size: int
+        Optional number of grid bins. When set, each KDE is binned onto a grid, smoothed with an FFT convolution
+        and sampled by inverse CDF lookup, which discretizes the density to the grid resolution. The estimates in
+        kde_estimates, including their datasets, are still kept, so this does not reduce memory use.
     """
-    def __init__(self, attribute_names, metric_function, valid_function, constants, attribute_data):
+    def __init__(self, attribute_names, metric_function, valid_function, constants, attribute_data, grid_size = None, seed = None, dtype = np.float64, vectorize_metric = False):
         ''''''
-        super(KdeSampler, self).__init__(attribute_names, metric_function, valid_function, constants)
-        self.kde_estimates = dict([(name, gaussian_kde(data)) for name, data in attribute_data.items() if name not in constants])
+        super(KdeSampler, self).__init__(attribute_names, metric_function, valid_function, constants, seed, dtype, vectorize_metric)
+        self.kde_estimates = dict([(name, CachedGaussianKde(data, self.random_state)) for name, data in attribute_data.items() if name not in constants])
         self.constants = constants
+        self.grid_size = grid_size
+        estimates = [self.kde_estimates[name] for name in self._varying_names]
+        if grid_size:
+            grids = [fft_kde_cdf(kde.dataset[0], kde.cho_cov[0, 0], grid_size) for kde in estimates]
+            self._grid_starts = np.array([edges[0] for edges, cdf in grids])
+            self._grid_steps = np.array([edges[1] - edges[0] for edges, cdf in grids])
+            self._grid_cdfs = np.array([cdf for edges, cdf in grids]).reshape(len(grids), grid_size + 1)
+            # Shifting every CDF by 2*row makes the concatenation increasing, so all attributes
+            # can be inverted with a single searchsorted call.
+            self._grid_offsets = 2*np.arange(len(grids))
+            self._grid_flat = (self._grid_cdfs + self._grid_offsets[:, None]).ravel()
+        else:
+            # Stack the per attribute datasets (padded to the longest one) and kernel bandwidths so that
+            # all attributes can be resampled with a single vectorized draw.
+            self._kde_sizes = np.array([kde.n for kde in estimates], dtype = int)
+            self._kde_data = np.zeros((len(estimates), max([kde.n for kde in estimates] or [0])))
+            for row, kde in enumerate(estimates):
+                self._kde_data[row, :kde.n] = kde.dataset[0]
+            self._kde_bandwidths = np.array([kde.cho_cov[0, 0] for kde in estimates])
+        self._constant_values = [constants[self._attr_list[i]] for i in self._const_indices]
         self.logger = logging.getLogger('Gaussian Sampler ' + str(id(self)))
 
-    def get_samples(self, count):
-        data = []
-        if count == 0:
-            return data
-        for name in self.attribute_names:
-            if name in self.constants:
-                data.append(count*[self.constants[name]])
-            data.append(self.kde_estimates[name].resample(count).tolist()[0])
-        return map(self.make_sample, zip(*data))
+    def get_samples_array(self, count):
+        count = int(count)
+        dims = len(self._varying_names)
+        if self.grid_size:
+            uniforms = self.random_state.uniform(size = (count, dims))
+            columns = np.arange(dims)
+            upper = np.searchsorted(self._grid_flat, uniforms + self._grid_offsets, side = 'right') - columns*(self.grid_size + 1)
+            upper = np.clip(upper, 1, self.grid_size)
+            cdf_low, cdf_high = self._grid_cdfs[columns, upper - 1], self._grid_cdfs[columns, upper]
+            fraction = np.where(cdf_high > cdf_low, (uniforms - cdf_low)/np.maximum(cdf_high - cdf_low, 1e-300), 0)
+            samples = self._grid_starts + (upper - 1 + fraction)*self._grid_steps
+        else:
+            indices = (self.random_state.uniform(size = (count, dims))*self._kde_sizes).astype(int)
+            samples = self._kde_data[np.arange(dims), indices] + self._kde_bandwidths*self.random_state.standard_normal((count, dims))
+        if not self._const_indices:
+            # The draws are already in attribute_names order.
+            return samples.astype(self.dtype, copy = False)
+        out = np.empty((count, len(self._attr_list)), dtype = self.dtype)
+        out[:, self._varying_indices] = samples
+        out[:, self._const_indices] = self._constant_values
+        return out
 
 class ToolSampler(Sampler):
     """ 
@@ -173,11 +540,18 @@ class ToolSampler(Sampler):
     param_buffer: string
         The file to write denoised parameters to. The tool picks up these parameters and generates output data.
     sample_buffer: string
-        The file that the tool writes output data to.
+        The file that the tool writes output data to. ToolSamplers in the same :py:class:`sampling.SamplerSet`
+        run concurrently unless they share param_buffer or sample_buffer, in which case they run one after another.
     script_path: string
         The path to the run script that comes packaged with the tool license. For more details see [3]_.
     params: list
         The mean parameters to supply to the ::py::class::`utils.NoiseModel`. Denoising is performed around these values
+    binary_buffer: bool
+        When set, the tool writes sample_buffer as raw little-endian float64 rows and writes the CSV header line
+        to header_buffer. This avoids parsing text for large outputs.
+    header_buffer: string
+        The file that the tool writes the CSV header line to when binary_buffer is set. Defaults to
+        sample_buffer + '.header'.
 
     ...
 
@@ -186,28 +560,102 @@ class ToolSampler(Sampler):
     .. [2] Add the reference here.
     .. [3] Add another reference here.
     """
-    def __init__(self, attribute_names, metric_function, valid_function, noise_model, constants, param_buffer, sample_buffer, script_path, params):
-        super(ToolSampler, self).__init__(attribute_names, metric_function, valid_function, constants)
+    def __init__(self, attribute_names, metric_function, valid_function, noise_model, constants, param_buffer, sample_buffer, script_path, params, binary_buffer = False, dtype = np.float64, vectorize_metric = False, header_buffer = None):
+        super(ToolSampler, self).__init__(attribute_names, metric_function, valid_function, constants, dtype = dtype, vectorize_metric = vectorize_metric)
         self.params = params
         self.noise_model = noise_model
         self.param_buffer = param_buffer
         self.sample_buffer = sample_buffer
         self.logger = logging.getLogger('Tool Sampler ' + str(id(self)))
         self.script_path = script_path
+        self.binary_buffer = binary_buffer
+        self.header_buffer = sample_buffer + '.header' if header_buffer is None else header_buffer
+        self._argv = self.script_command(script_path)
+
+    @staticmethod
+    def script_command(script_path):
+        """
+        Works out the command line that runs the script. Scripts with a shebang line are run by the
+        interpreter it names, and others by bash.
+        """
+        try:
+            with open(script_path, "r") as f:
+                first_line = f.readline()
+        except IOError:
+            first_line = ''
+        if first_line.startswith('#!'):
+            return shlex.split(first_line[2:]) + [script_path]
+        return ['bash', script_path]
+
+    def buffer_paths(self):
+        paths = [self.param_buffer, self.sample_buffer] + ([self.header_buffer] if self.binary_buffer else [])
+        return frozenset(os.path.abspath(path) for path in paths)
 
     def get_samples(self, count):
+        return self.get_samples_async(count).result()
+
+    def get_samples_array(self, count):
+        return self.finish_tool(self.start_tool(count), count)
+
+    def get_samples_async(self, count):
+        process = self.start_tool(count)
+        return SampleFuture(self.make_samples, process, lambda: self.finish_tool(process, count))
+
+    def start_tool(self, count):
+        """Writes denoised parameters to param_buffer and starts a tool run. Returns the process, or None when count is 0."""
         if count == 0:
-            return []
-        parameter_values = self.noise_model.add_noise(self.params, count)
+            return None
+        parameter_values = np.atleast_2d(self.noise_model.add_noise(self.params, count))
+        # Same output as np.savetxt(f, parameter_values, delimiter = ',', fmt = '%1.5f'), formatted in one
+        # operation instead of one call per row.
+        row_format = ','.join(['%1.5f']*parameter_values.shape[1]) + '\n'
         with open(self.param_buffer,"w+") as f:
-            np.savetxt(f, parameter_values, delimiter = ',', fmt = '%1.5f')
-        subprocess.call('source ' + self.script_path, shell = True)
-        values = []
+            f.write((row_format*len(parameter_values)) % tuple(parameter_values.ravel().tolist()))
+        return subprocess.Popen(self._argv)
+
+    def finish_tool(self, process, count):
+        """
+        Waits for a run started by start_tool and parses its output. Raises subprocess.CalledProcessError
+        if the tool exited with an error, instead of returning the stale contents of sample_buffer.
+        """
+        if process is not None:
+            process.wait()
+            if process.returncode:
+                raise subprocess.CalledProcessError(process.returncode, ' '.join(self._argv))
+        return self.read_samples_array(count)
+
+    def read_samples_array(self, count):
+        """Parses the attribute values that the tool wrote to sample_buffer."""
+        if count == 0:
+            return np.empty((0, len(self._attr_list)), dtype = self.dtype)
+        if self.binary_buffer:
+            with open(self.header_buffer,"r") as f:
+                attributes = self.check_header(f.readline())
+            return self.read_binary_buffer(len(attributes))
         with open(self.sample_buffer,"r") as f:
-            header = f.readline()
-            attributes = header.rstrip().split(",")
-            if attributes != list(self.attribute_names):
-                self.logger.warning('Attribute name mismatch encountered in buffer: trying to ignore')
-            for line in f:
-                values.append(map(float, line.split(',')))
-        return map(self.make_sample,values)
+            attributes = self.check_header(f.readline())
+            values = f.read()
+        values = values.strip()
+        if not values:
+            return np.empty((0, len(attributes)), dtype = self.dtype)
+        # np.fromstring parses the whole body in C; np.loadtxt is a Python loop on the numpy versions we support.
+        rows = values.count('\n') + 1
+        parsed = np.fromstring(values.replace('\n', ','), sep = ',', dtype = self.dtype)
+        if parsed.size != rows*len(attributes):
+            raise Exception('Malformed sample buffer: expected ' + str(rows) + ' rows of ' + str(len(attributes)) + ' values')
+        return parsed.reshape(rows, len(attributes))
+
+    def check_header(self, header):
+        """Splits the CSV header line written by the tool, warning if it does not match attribute_names."""
+        attributes = header.rstrip().split(",")
+        if attributes != self._attr_list:
+            self.logger.warning('Attribute name mismatch encountered in buffer: trying to ignore')
+        return attributes
+
+    def read_binary_buffer(self, width):
+        """Reads sample_buffer as rows of width little-endian float64 values."""
+        size = os.path.getsize(self.sample_buffer)
+        if size % (8*width):
+            raise Exception('Malformed binary sample buffer: ' + str(size) + ' bytes is not a whole number of rows of ' + str(width) + ' float64 values')
+        with open(self.sample_buffer,"rb") as f:
+            return np.fromfile(f, dtype = '<f8').reshape(-1, width).astype(self.dtype, copy = False)
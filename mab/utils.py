@@ -31,14 +31,19 @@ import uuid
 import numpy as np
 
 class Sample:
-	def __init__(self, attributes, metric, valid):
+	def __init__(self, attributes, metric, valid, metric_value = None, valid_value = None):
 		self.logger = logging.getLogger('Sample')
 		self.attributes = attributes
 		self.metric = metric
 		self.valid = valid
+		# Optional values precomputed for a whole batch, see Sampler.evaluate.
+		self.metric_value = metric_value
+		self.valid_value = valid_value
 		self.id = uuid.uuid4()
 
 	def get_metric(self):
+		if self.metric_value is not None:
+			return self.metric_value
 		try:
 			return self.metric(self.attributes)
 		except Exception as err:
@@ -46,6 +51,8 @@ class Sample:
 			raise Exception('Metric evaluation failed', err)
 
 	def is_valid(self):
+		if self.valid_value is not None:
+			return self.valid_value
 		try:
 			return self.valid(self.attributes)
 		except Exception as err:
@@ -73,15 +80,59 @@ class Sample:
 	#	d['logger'] = None
 	#	return d
 
+def make_random_state(seed = None):
+	"""
+	Creates an independent random number generator. Uses numpy.random.Generator when the installed
+	numpy provides it and falls back to numpy.random.RandomState otherwise. Callers should stick to
+	methods that both provide (e.g. standard_normal and uniform).
+	"""
+	return getattr(np.random, 'default_rng', np.random.RandomState)(seed)
+
+def fft_kde_cdf(data, bandwidth, grid_size):
+	"""
+	Computes the CDF of a 1-D gaussian KDE on a regular grid. The data is binned into a histogram
+	that is convolved with the gaussian kernel in the frequency domain, so the cost is
+	O(len(data) + grid_size*log(grid_size)) instead of evaluating every kernel at every grid point.
+
+	...
+
+	Parameters
+	__________
+	data: list
+		The 1-D data the KDE is fit to.
+	bandwidth: float
+		The standard deviation of the gaussian kernel.
+	grid_size: int
+		The number of grid bins.
+
+	Returns
+	_______
+	edges, cdf:
+		The grid edges and the CDF values at those edges, suitable for inverse CDF sampling with np.interp.
+	"""
+	data = np.asarray(data, dtype = float)
+	low, high = data.min() - 4*bandwidth, data.max() + 4*bandwidth
+	counts, edges = np.histogram(data, bins = grid_size, range = (low, high))
+	# Zero padding keeps the circular convolution from wrapping mass across the grid boundaries.
+	padded = 2*grid_size
+	freqs = np.fft.rfftfreq(padded, d = edges[1] - edges[0])
+	kernel = np.exp(-0.5*(2*np.pi*freqs*bandwidth)**2)
+	density = np.fft.irfft(np.fft.rfft(counts, padded)*kernel, padded)[:grid_size]
+	cdf = np.concatenate(([0], np.cumsum(np.maximum(density, 0))))
+	return edges, cdf/cdf[-1]
+
 class NoiseModel(object):
 	def add_noise(self, x, count):
 		raise NotImplementedError()
 
 class GaussianNoiseModel(NoiseModel):
-	def __init__(self, variance):
+	def __init__(self, variance, seed = None):
 		self.variance = variance
+		self.random_state = make_random_state(seed)
+		self._stds = np.sqrt(np.asarray(variance, dtype = float))
 	def add_noise(self, x, count):
 		if len(x) != len(self.variance):
 			raise Exception('Dimension mismatch: expected x with dim ' + str(len(self.variance)))
-		return np.random.multivariate_normal(x, np.diag(self.variance),count)
+		# Diagonal covariance: scale standard normals instead of factorizing np.diag(variance) per call.
+		return np.asarray(x, dtype = float) + self._stds*self.random_state.standard_normal((int(count), self._stds.size))
 
@@ -0,0 +1 @@
+echo a,b > tests/header.tmp
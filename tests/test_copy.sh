@@ -0,0 +1,2 @@
+echo a,b > tests/copy_samples.tmp
+cat tests/copy_params.tmp >> tests/copy_samples.tmp
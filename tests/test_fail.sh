@@ -0,0 +1 @@
+exit 3
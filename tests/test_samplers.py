@@ -28,12 +28,14 @@
 
 from context import mab
 from mab.sampling import *
-from mab.utils import GaussianNoiseModel
+from mab.utils import GaussianNoiseModel, fft_kde_cdf, make_random_state
 import unittest
 import random
 from mock import MagicMock
 import pdb
 import numpy as np
+import threading
+import subprocess
 
 class TestSamplers(unittest.TestCase):
 	def test_base_sampler_make(self):
@@ -48,6 +50,42 @@ class TestSamplers(unittest.TestCase):
 			self.assertTrue(name in random_attributes or name in random_constants)
 		self.assertEqual(round(sample.get_metric(), 3), round(sum(random_values) + 1, 3))
 
+	def test_base_sampler_make_many(self):
+		sampler = Sampler(['a', 'constant1', 'b'], lambda x: x['a'] + x['b'], lambda x: True, {'constant1': 1})
+		samples = sampler.make_samples(np.array([[1, 7, 2], [3, 7, 4]]))
+		self.assertEqual(len(samples), 2)
+		for sample, made in zip(samples, [sampler.make_sample(v) for v in [[1, 7, 2], [3, 7, 4]]]):
+			self.assertEqual(sample.attributes, made.attributes)
+			self.assertEqual(sample.attributes['constant1'], 1)
+		self.assertEqual([s.get_metric() for s in samples], [3, 7])
+		self.assertEqual(sampler.make_samples([]), [])
+
+	def test_base_sampler_vectorized_metric(self):
+		calls = []
+		def metric(x):
+			calls.append(np.shape(x['a']))
+			return 2*x['a'] + x['b'] + x['constant1']
+		values = np.array([[1., 2.], [3., 4.], [5., 6.]])
+		sampler = Sampler(['a', 'b'], metric, lambda x: x['a'] > 2, {'constant1': 1}, vectorize_metric = True)
+		samples = sampler.make_samples(values)
+		# One batch call, checked against per sample calls on the first two rows.
+		self.assertEqual(calls, [(3,), (), ()])
+		self.assertEqual([s.get_metric() for s in samples], [5, 11, 17])
+		self.assertEqual([s.is_valid() for s in samples], [False, True, True])
+		self.assertEqual(calls, [(3,), (), ()])
+		# Functions that only work per sample fall back to per sample evaluation.
+		sampler = Sampler(['a', 'b'], lambda x: max(x['a'], x['b']), lambda x: x['a'] > 2 and x['b'] > 2, {}, vectorize_metric = True)
+		samples = sampler.make_samples(values)
+		self.assertEqual([s.get_metric() for s in samples], [2, 4, 6])
+		self.assertEqual([s.is_valid() for s in samples], [False, True, True])
+		# np.dot returns one value per sample for a batch of two, but combines the wrong entries.
+		sampler = Sampler(['a', 'b'], lambda x: np.dot([x['a'], x['b']], [1., 2.]), lambda x: True, {}, vectorize_metric = True)
+		self.assertEqual([s.get_metric() for s in sampler.make_samples(values[:2])], [5, 11])
+		sampler = Sampler(['a', 'b'], metric, lambda x: True, {'constant1': 1})
+		del calls[:]
+		self.assertEqual([s.get_metric() for s in sampler.make_samples(values)], [5, 11, 17])
+		self.assertEqual(calls, [()]*3)
+
 	def test_base_sampler_get(self):
 		random_attributes = ["random_name0", "random_name1"]
 		random_constants = {'constant1': 1}
@@ -66,6 +104,90 @@ class TestSamplers(unittest.TestCase):
 		self.assertEqual(map(lambda x: x.get_metric(), samples[0]), [0]*5)
 		self.assertEqual(map(lambda x: x.get_metric(), samples[1]), [1]*9)
 
+	def test_sample_handler_starts_all_batches(self):
+		events = []
+		class RecordingSampler(Sampler):
+			def get_samples_async(self, count):
+				events.append(('start', count))
+				return SampleFuture(lambda: events.append(('finish', count)) or [self.make_sample([count])]*count)
+		samplers = [RecordingSampler(['name'], lambda x: x['name'], lambda x: True, {}) for i in range(3)]
+		samples = SamplerSet(samplers).get_samples([1, 2, 3])
+		self.assertEqual(map(len, samples), [1, 2, 3])
+		self.assertEqual(events, [('start', 1), ('start', 2), ('start', 3), ('finish', 1), ('finish', 2), ('finish', 3)])
+
+	def test_sample_handler_finishes_concurrently(self):
+		events = [threading.Event() for i in range(3)]
+		class WaitingProcess(object):
+			def __init__(self, index):
+				self.index = index
+			def wait(self):
+				events[self.index].set()
+				self.concurrent = all(e.wait(5) or e.is_set() for e in events)
+		threads = []
+		class WaitingSampler(Sampler):
+			def get_samples_async(self, count):
+				process = WaitingProcess(count)
+				return SampleFuture(lambda output: threads.append(threading.current_thread()) or [process.concurrent], process, lambda: None)
+		class LocalSampler(Sampler):
+			def get_samples(self, count):
+				threads.append(threading.current_thread())
+				return []
+		samplers = [WaitingSampler(['name'], lambda x: 0, lambda x: True, {}) for i in range(3)] + [LocalSampler(['name'], lambda x: 0, lambda x: True, {})]
+		active = threading.active_count()
+		for i in range(5):
+			self.assertEqual(SamplerSet(samplers).get_samples([0, 1, 2, 1]), [[True]]*3 + [[]])
+			for e in events:
+				e.clear()
+		self.assertEqual(threads, [threading.current_thread()]*20)
+		self.assertEqual(threading.active_count(), active)
+
+	def test_sample_handler_shared_tool_buffers(self):
+		make = lambda params: ToolSampler(['a', 'b'], lambda x: x['a'], lambda x: True, GaussianNoiseModel([0, 0]), {}, 'tests/copy_params.tmp', 'tests/copy_samples.tmp', 'tests/test_copy.sh', params)
+		arms = [make([1, 1]), make([100, 100])]
+		samples = SamplerSet(arms).get_samples([2, 3])
+		self.assertEqual([[s.attributes['a'] for s in arm] for arm in samples], [[1.0]*2, [100.0]*3])
+		# The same sampler used for several arms shares its buffers with itself.
+		samples = SamplerSet([arms[0], arms[1], arms[0]]).get_samples([2, 3, 4])
+		self.assertEqual(map(len, samples), [2, 3, 4])
+		self.assertEqual([[s.attributes['a'] for s in arm] for arm in samples], [[1.0]*2, [100.0]*3, [1.0]*4])
+
+	def test_sample_handler_tool_callbacks_on_calling_thread(self):
+		threads = []
+		def metric(x):
+			threads.append(threading.current_thread())
+			return x['a'] + x['b']
+		samplers = []
+		for arm in range(2):
+			with open('tests/arm%d.tmp' % arm, 'w') as f:
+				f.write('echo a,b > tests/arm%d_samples.tmp\nfor ((i=0; i<3; i++)); do echo %d,$i; done >> tests/arm%d_samples.tmp\n' % (arm, arm, arm))
+			samplers.append(ToolSampler(['a', 'b'], metric, lambda x: True, GaussianNoiseModel([0.01, 0.1]), {}, 'tests/arm%d_params.tmp' % arm, 'tests/arm%d_samples.tmp' % arm, 'tests/arm%d.tmp' % arm, [1, 2], vectorize_metric = True))
+		samples = SamplerSet(samplers).get_samples([3, 3])
+		self.assertEqual([[s.get_metric() for s in arm] for arm in samples], [[0, 1, 2], [1, 2, 3]])
+		self.assertTrue(len(threads) > 0)
+		self.assertEqual(set(threads), set([threading.current_thread()]))
+
+	def test_sample_handler_batches_gaussians(self):
+		narrow = GaussianSampler(['a'], lambda x: x['a'], lambda x: True, {'constant1': 1}, [5], [0.5])
+		wide = GaussianSampler(['a', 'b'], lambda x: x['a'], lambda x: True, {}, [-1, 10], [1, 2])
+		other = Sampler(['a'], lambda x: x['a'], lambda x: True, {})
+		other.get_samples = lambda x: [other.make_sample([0])]*x
+		samples = SamplerSet([narrow, other, wide, narrow]).get_samples([4000, 3, 5000, 0])
+		self.assertEqual(map(len, samples), [4000, 3, 5000, 0])
+		self.assertEqual(sorted(samples[0][0].attributes.keys()), ['a', 'constant1'])
+		narrow_values = np.array([s.attributes['a'] for s in samples[0]])
+		wide_values = np.array([[s.attributes['a'], s.attributes['b']] for s in samples[2]])
+		self.assertTrue(np.allclose([narrow_values.mean(), narrow_values.std()], [5, 0.5], atol = 0.1))
+		self.assertTrue(np.allclose(wide_values.mean(axis = 0), [-1, 10], atol = 0.1))
+		self.assertTrue(np.allclose(wide_values.std(axis = 0), [1, 2], atol = 0.1))
+
+	def test_sample_handler_keeps_sampler_seeds(self):
+		make = lambda: GaussianSampler(['a'], lambda x: x['a'], lambda x: True, {}, [0], [1], seed = 1)
+		expected = [s.attributes['a'] for s in make().get_samples(5)]
+		for i in range(3):
+			unseeded = [GaussianSampler(['a'], lambda x: x['a'], lambda x: True, {}, [0], [1]) for j in range(2)]
+			samples = SamplerSet([unseeded[0], make(), unseeded[1]]).get_samples([3, 5, 4])
+			self.assertEqual([s.attributes['a'] for s in samples[1]], expected)
+
 	def test_gaussian_get_samples(self):
 		sampler = GaussianSampler(['a', 'b'], lambda x: sum(x.values()), lambda x: True, {'constant1': 1}, [1.1, 2], [1, 1])
 		samples = sampler.get_samples(10)
@@ -74,6 +196,52 @@ class TestSamplers(unittest.TestCase):
 			self.assertEqual(sample.attributes.keys(), ['a', 'b', 'constant1'])
 			self.assertEqual(sample.attributes['constant1'], 1)
 
+	def test_gaussian_sample_moments(self):
+		sampler = GaussianSampler(['a', 'b'], lambda x: sum(x.values()), lambda x: True, {'constant1': 1}, [1.1, -2], [0.5, 2])
+		values = np.array([[s.attributes['a'], s.attributes['b']] for s in sampler.get_samples(20000)])
+		self.assertTrue(np.allclose(values.mean(axis = 0), [1.1, -2], atol = 0.1))
+		self.assertTrue(np.allclose(values.std(axis = 0), [0.5, 2], atol = 0.1))
+
+	def test_seeded_samplers_repeat(self):
+		data = {'a' : [1, 2, 3], 'b': [1, 1.1, 1.2]}
+		make = [lambda: GaussianSampler(['a', 'b'], lambda x: 0, lambda x: True, {}, [1, 2], [1, 1], seed = 7),
+			lambda: KdeSampler(['a', 'b'], lambda x: 0, lambda x: True, {}, data, seed = 7)]
+		for build in make:
+			first, second = build().get_samples(5), build().get_samples(5)
+			self.assertEqual([s.attributes for s in first], [s.attributes for s in second])
+		self.assertTrue(np.array_equal(GaussianNoiseModel([1, 1], seed = 3).add_noise([0, 0], 4), GaussianNoiseModel([1, 1], seed = 3).add_noise([0, 0], 4)))
+
+	def test_get_samples_array(self):
+		data = {'a' : [1, 2, 3], 'b': [1, 1.1, 1.2]}
+		samplers = [GaussianSampler(['a', 'constant1', 'b'], lambda x: 0, lambda x: True, {'constant1': 1}, [1, 0, 2], [1, 1, 1]),
+			KdeSampler(['a', 'constant1', 'b'], lambda x: 0, lambda x: True, {'constant1': 1}, data)]
+		for sampler in samplers:
+			values = sampler.get_samples_array(6)
+			self.assertTrue(isinstance(values, np.ndarray))
+			self.assertEqual(values.shape, (6, 3))
+			self.assertEqual(sampler.get_samples_array(0).shape, (0, 3))
+		self.assertRaises(NotImplementedError, Sampler(['a'], lambda x: 0, lambda x: True, {}).get_samples_array, 1)
+
+	def test_cached_kde_resample(self):
+		kde = CachedGaussianKde([1, 2, 3, 4, 5], make_random_state(1))
+		self.assertTrue(np.allclose(np.dot(kde.cho_cov, kde.cho_cov.T), kde.covariance))
+		values = kde.resample(20000)
+		self.assertEqual(values.shape, (1, 20000))
+		self.assertAlmostEqual(values.mean(), 3, delta = 0.1)
+		self.assertAlmostEqual(values.var(), 2 + kde.covariance[0, 0], delta = 0.2)
+		kde.set_bandwidth(0.01)
+		self.assertTrue(np.allclose(np.dot(kde.cho_cov, kde.cho_cov.T), kde.covariance))
+		self.assertTrue(set(np.round(kde.resample(100)[0])) <= set([1, 2, 3, 4, 5]))
+
+	def test_single_precision_samples(self):
+		data = {'a' : [1, 2, 3], 'b': [1, 1.1, 1.2]}
+		samplers = [GaussianSampler(['a', 'b'], lambda x: 0, lambda x: True, {}, [1, 2], [1, 1], dtype = np.float32),
+			KdeSampler(['a', 'b'], lambda x: 0, lambda x: True, {}, data, dtype = np.float32)]
+		for sampler in samplers:
+			self.assertEqual(sampler.get_samples_array(4).dtype, np.float32)
+			self.assertEqual(sampler.get_samples_array(0).dtype, np.float32)
+		self.assertEqual(GaussianSampler(['a'], lambda x: 0, lambda x: True, {}, [1], [1]).get_samples_array(2).dtype, np.float64)
+
 	def test_kde_get_samples(self):
 		data = {'a' : [1, 2, 3], 'b': [1, 1.1, 1.2]}
 		sampler = KdeSampler(['a', 'b'], lambda x: sum(x.values()), lambda x: True, {'constant1': 1}, data)
@@ -83,6 +251,42 @@ class TestSamplers(unittest.TestCase):
 			self.assertEqual(sample.attributes.keys(), ['a', 'b', 'constant1'])
 			self.assertEqual(sample.attributes['constant1'], 1)
 
+	def test_kde_sample_moments(self):
+		data = {'a' : [1, 2, 3, 4, 5], 'b': [10, 11, 12]}
+		sampler = KdeSampler(['a', 'b'], lambda x: sum(x.values()), lambda x: True, {}, data)
+		values = np.array([[s.attributes['a'], s.attributes['b']] for s in sampler.get_samples(20000)])
+		for column, name in enumerate(['a', 'b']):
+			kde = sampler.kde_estimates[name]
+			self.assertAlmostEqual(values[:, column].mean(), np.mean(data[name]), delta = 0.1)
+			self.assertAlmostEqual(values[:, column].var(), np.var(data[name]) + kde.covariance[0, 0], delta = 0.2)
+
+	def test_kde_grid_sample_moments(self):
+		data = {'a' : np.random.normal(3, 1, 5000), 'b': [10, 11, 12]}
+		sampler = KdeSampler(['a', 'b'], lambda x: sum(x.values()), lambda x: True, {}, data, grid_size = 512)
+		values = np.array([[s.attributes['a'], s.attributes['b']] for s in sampler.get_samples(20000)])
+		for column, name in enumerate(['a', 'b']):
+			kde = sampler.kde_estimates[name]
+			self.assertAlmostEqual(values[:, column].mean(), np.mean(data[name]), delta = 0.1)
+			self.assertAlmostEqual(values[:, column].var(), np.var(data[name]) + kde.covariance[0, 0], delta = 0.2)
+
+	def test_kde_grid_inverse_cdf(self):
+		data = {'a' : np.random.normal(3, 1, 500), 'b': np.random.uniform(-5, 5, 500)}
+		sampler = KdeSampler(['a', 'b'], lambda x: sum(x.values()), lambda x: True, {}, data, grid_size = 256)
+		samples = np.array([[s.attributes['a'], s.attributes['b']] for s in sampler.get_samples(1000)])
+		for column, name in enumerate(['a', 'b']):
+			edges, cdf = fft_kde_cdf(data[name], sampler.kde_estimates[name].cho_cov[0, 0], 256)
+			expected = np.interp(np.interp(samples[:, column], edges, cdf), cdf, edges)
+			self.assertTrue(np.allclose(samples[:, column], expected))
+
+	def test_kde_constant_in_attributes(self):
+		data = {'a' : [1, 2, 3], 'b': [1, 1.1, 1.2]}
+		sampler = KdeSampler(['a', 'constant1', 'b'], lambda x: sum(x.values()), lambda x: True, {'constant1': 5}, data)
+		samples = sampler.get_samples(10)
+		self.assertEqual(len(samples), 10)
+		for sample in samples:
+			self.assertEqual(sample.attributes['constant1'], 5)
+			self.assertTrue(0 < sample.attributes['b'] < 2.5)
+
 	def test_kde_constant_with_data(self):
 		data = {'a' : [1, 2, 3], 'b': [1, 1.1, 1.2], 'constant1': [1, 2]}
 		sampler = KdeSampler(['a', 'b'], lambda x: sum(x.values()), lambda x: True, {'constant1': 1}, data)
@@ -98,6 +302,64 @@ class TestSamplers(unittest.TestCase):
 		self.assertEqual(len(samples), 10)
 		for index, sample in enumerate(samples):
 			self.assertEqual(sample.attributes.values(), [index, index, 1])
+		self.assertTrue(np.array_equal(sampler.get_samples_array(10), [[i, i] for i in range(10)]))
+		sampler.dtype = np.float32
+		self.assertEqual(sampler.get_samples_array(10).dtype, np.float32)
+
+	def test_gaussian_noise_model(self):
+		noise_model = GaussianNoiseModel([0.01, 4])
+		noise = noise_model.add_noise([1, 2], 20000)
+		self.assertEqual(noise.shape, (20000, 2))
+		self.assertTrue(np.allclose(noise.mean(axis = 0), [1, 2], atol = 0.1))
+		self.assertTrue(np.allclose(noise.var(axis = 0), [0.01, 4], rtol = 0.1))
+		self.assertRaises(Exception, noise_model.add_noise, [1], 5)
+
+	def test_tool_failure(self):
+		noise_model = GaussianNoiseModel([0.01, 0.1])
+		with open('tests/samples.tmp', 'w') as f:
+			f.write('a,b\n7,7\n')
+		sampler = ToolSampler(['a', 'b'], lambda x: sum(x.values()), lambda x: True, noise_model, {}, 'tests/params.tmp', 'tests/samples.tmp', "tests/test_fail.sh", [1, 2])
+		self.assertRaises(subprocess.CalledProcessError, sampler.get_samples, 1)
+		self.assertRaises(subprocess.CalledProcessError, sampler.get_samples_array, 1)
+
+	def test_tool_ragged_buffer(self):
+		noise_model = GaussianNoiseModel([0.01, 0.1])
+		sampler = ToolSampler(['a', 'b'], lambda x: sum(x.values()), lambda x: True, noise_model, {}, 'tests/params.tmp', 'tests/ragged.tmp', "tests/test.sh", [1, 2])
+		with open('tests/ragged.tmp', 'w') as f:
+			f.write('a,b\n1,2\n3\n4,5\n')
+		self.assertRaises(Exception, sampler.read_samples_array, 3)
+		with open('tests/ragged.tmp', 'w') as f:
+			f.write('a,b\n1,2\n3,4\n')
+		self.assertTrue(np.array_equal(sampler.read_samples_array(2), [[1, 2], [3, 4]]))
+
+	def test_tool_binary_buffer(self):
+		noise_model = GaussianNoiseModel([0.01, 0.1])
+		values = np.arange(20, dtype = '<f8').reshape(10, 2)
+		values.tofile('tests/samples.tmp')
+		sampler = ToolSampler(['a', 'b'], lambda x: sum(x.values()), lambda x: True, noise_model, {'constant1': 1}, 'tests/params.tmp', 'tests/samples.tmp', "tests/test_binary.sh", [1, 2], binary_buffer = True, header_buffer = 'tests/header.tmp')
+		samples = sampler.get_samples(10)
+		self.assertEqual(len(samples), 10)
+		for row, sample in zip(values, samples):
+			self.assertEqual(sample.attributes, {'a': row[0], 'b': row[1], 'constant1': 1})
+		open('tests/samples.tmp', 'w').close()
+		self.assertEqual(sampler.get_samples_array(3).shape, (0, 2))
+		values[:5].ravel()[:-1].tofile('tests/samples.tmp')
+		self.assertRaises(Exception, sampler.get_samples_array, 5)
+
+	def test_tool_script_command(self):
+		command = ToolSampler.script_command("tests/test.sh")
+		self.assertEqual(command, ['bash', "tests/test.sh"])
+		with open('tests/shebang.tmp', 'w') as f:
+			f.write('#!/bin/sh -e\necho\n')
+		self.assertEqual(ToolSampler.script_command('tests/shebang.tmp'), ['/bin/sh', '-e', 'tests/shebang.tmp'])
+
+	def test_tool_param_buffer(self):
+		noise_model = GaussianNoiseModel([0.01, 0.1])
+		noise_model.add_noise = MagicMock(return_value = np.array([[1.234567, -2], [3, 4.5]]))
+		sampler = ToolSampler(['a', 'b'], lambda x: sum(x.values()), lambda x: True, noise_model, {'constant1': 1}, 'tests/params.tmp', 'tests/samples.tmp', "tests/test.sh", [1, 2])
+		sampler.get_samples(2)
+		with open('tests/params.tmp') as f:
+			self.assertEqual(f.read(), '1.23457,-2.00000\n3.00000,4.50000\n')
 
 if __name__ == "__main__":
 	unittest.main()
\ No newline at end of file